@@ -1,147 +1,193 @@
 #!/usr/bin/env python3
 
 import logging
-import os
-import json
-import sys
+import random
 import requests
 import traceback
-import urllib.parse
-import config
-from slskd import all_downloads_completed, get_download_status
-
-try:
-    DEBUG = config.DEBUG
-except AttributeError:
-    DEBUG = False
-
-logging.basicConfig(
-    level=logging.DEBUG if DEBUG else logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+from settings import CFG
+from lifecycle import shutdown_event
+from json_compat import dumps_pretty, loads
+from circuit_breaker import CircuitBreaker, CircuitOpenError, call
+from http_session import make_session
+from slskd import _index_downloads, _normalize, all_downloads_completed, get_download_status, is_directory_completed
+
 logger = logging.getLogger("betanin")
 
+_session = make_session(CFG.BETANIN_API_KEY, Accept="application/json")
+
+TORRENTS_URL = f"{CFG.BETANIN_URL}/api/torrents/"
+# Parámetros para consultar solo el último torrent
+LATEST_TORRENT_PARAMS = {"page": 1, "per_page": 1}
+
+# Corta las consultas durante una caída de betanin en vez de esperar cada timeout
+_betanin_cb = CircuitBreaker("betanin")
+
+# Reintentos del POST de importación ante errores de conexión o 5xx
+IMPORT_ATTEMPTS = 3
+IMPORT_MAX_DELAY = 8
+
+# La verificación de conexión solo se hace una vez por proceso; después
+# el código de estado del POST basta para detectar errores
+_connection_checked = False
+
 
-def import_downloads(parent_directory):
+def _check_connection():
     """
-    Imports the downloads using the betanin API.
+    Verifies connectivity with the betanin API before the first import.
     """
-    logger.info(f"Importing downloads from : {parent_directory}")
+    global _connection_checked
+
+    logger.info("🔍 Checking betanin connection...")
+    logger.debug("🔗 TEST URL: %s", TORRENTS_URL)
+
+    try:
+        check_response = call(_betanin_cb, _session.get, TORRENTS_URL, params=LATEST_TORRENT_PARAMS, timeout=10)
+        logger.info(f"📡 Verification response: Status {check_response.status_code}")
+
+        if check_response.status_code == 200:
+            logger.info("✅ Betanin connection established correctly")
+            if logger.isEnabledFor(logging.DEBUG):
+                try:
+                    logger.debug("📊 Data: %s", dumps_pretty(loads(check_response.content)))
+                except:
+                    logger.debug("📝 Response: %s", check_response.text[:500])
+            _connection_checked = True
+            return True
 
-    if not config.BETANIN_API_KEY:
-        logger.error("❌ BETANIN_API_KEY is not configured. Cannot import.")
+        logger.error(f"❌ Error connecting to betanin: {check_response.status_code}")
+        if check_response.status_code == 401:
+            logger.error("🔐 Authentication error: Incorrect API key or missing permissions")
+        logger.error(f"📝 Full response: {check_response.text[:500]}")
+        return False
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error checking connection: {e}")
+        logger.error(traceback.format_exc())
         return False
 
-    url = f"{config.BETANIN_URL}/api/torrents/"
-    headers = {"X-API-Key": config.BETANIN_API_KEY, "Content-Type": "application/x-www-form-urlencoded"}
+
+def import_downloads(parent_directory, download_data=None, _index=None):
+    """
+    Imports the downloads using the betanin API.
+
+    Args:
+        parent_directory: Name of the downloaded directory to import
+        download_data: Download status data already fetched from slskd.
+            If None, it is fetched again.
+        _index: Prebuilt index of download_data from slskd._index_downloads
+
+    Raises:
+        CircuitOpenError: If slskd's circuit is open while fetching download_data, or
+            betanin's circuit is already open before the first import attempt
+    """
+    logger.info(f"Importing downloads from : {parent_directory}")
 
     # Normalize directory name (remove backslashes and problematic characters)
-    directory_name = os.path.basename(parent_directory.replace('\\', '/'))
+    directory_name = _normalize(parent_directory)
 
     # Build the betanin path and encode it correctly for POST
-    betanin_path = f"{config.BETANIN_IMPORT_DIRECTORY}/{directory_name}"
+    betanin_path = f"{CFG.BETANIN_IMPORT_DIRECTORY}/{directory_name}"
     logger.info(f"📁 Import path: {betanin_path}")
 
-    # Check download status
-    download_data = get_download_status()
-    all_completed, completed_files, total_files = all_downloads_completed(download_data)
+    # Check download status, unless the caller already has it
+    if download_data is None:
+        download_data = get_download_status()
+        _index = None
+
+    # Global and directory status from a single pass over the download data
+    if _index is None:
+        _index = _index_downloads(download_data)
 
+    all_completed, completed_files, total_files = all_downloads_completed(download_data, _index=_index)
     logger.info(f"📊 Global download status: {completed_files}/{total_files} completed files")
 
-    # Check specific directory status
-    try:
-        from slskd import is_directory_completed
-        dir_completed = is_directory_completed(download_data, directory_name)
-        logger.info(f"📊 Directory {directory_name} status: {'✅ Completed' if dir_completed else '⏳ Incomplete'}")
+    dir_completed = is_directory_completed(download_data, directory_name, _index=_index)
+    logger.info(f"📊 Directory {directory_name} status: {'✅ Completed' if dir_completed else '⏳ Incomplete'}")
 
-        if not dir_completed:
-            logger.warning(f"⚠️ Directory not fully completed, but trying to import anyway")
-    except Exception as e:
-        logger.error(f"❌ Error checking specific directory status: {e}")
+    if not dir_completed:
+        logger.warning(f"⚠️ Directory not fully completed, but trying to import anyway")
 
     # Prepare data to send
     data = {"both": betanin_path}
 
     try:
         # Show more details about the request for debugging
-        logger.info(f"🔗 BETANIN URL: {url}")
-        logger.info(f"🔑 Headers: {headers}")
-        logger.info(f"📦 Data: {data}")
-
-        # Try a GET request first to verify connectivity
-        logger.info("🔍 Checking betanin connection...")
-        check_url = f"{config.BETANIN_URL}/api/torrents/?page=1&per_page=1"
-        logger.info(f"🔗 TEST URL: {check_url}")
-
-        try:
-            check_headers = {"X-API-Key": config.BETANIN_API_KEY, "accept": "application/json"}
-            check_response = requests.get(check_url, headers=check_headers, timeout=10)
-            logger.info(f"📡 Verification response: Status {check_response.status_code}")
-
-            if check_response.status_code == 200:
-                logger.info("✅ Betanin connection established correctly")
-                try:
-                    logger.debug(f"📊 Data: {json.dumps(check_response.json(), indent=2)}")
-                except:
-                    logger.debug(f"📝 Response: {check_response.text[:500]}")
-            else:
-                logger.error(f"❌ Error connecting to betanin: {check_response.status_code}")
-                if check_response.status_code == 401:
-                    logger.error("🔐 Authentication error: Incorrect API key or missing permissions")
-                logger.error(f"📝 Full response: {check_response.text[:500]}")
-                return False
-        except Exception as e:
-            logger.error(f"❌ Error checking connection: {e}")
-            logger.error(traceback.format_exc())
+        logger.debug("🔗 BETANIN URL: %s", TORRENTS_URL)
+        logger.debug("📦 Data: %s", data)
+
+        if not _connection_checked and not _check_connection():
             return False
 
         # Now perform the import request
         logger.info(f"📤 Sending import request to betanin...")
 
-        try:
-            # Ensure the data is sent correctly
-            # Use urllib.parse to encode the parameters correctly
-            encoded_data = urllib.parse.urlencode(data)
-            logger.debug(f"📦 Encoded data: {encoded_data}")
-
-            # Ensure Content-Type is correct for form data
-            import_headers = {
-                "X-API-Key": config.BETANIN_API_KEY,
-                "Content-Type": "application/x-www-form-urlencoded",
-                "Accept": "application/json"
-            }
-
-            # Realizar la solicitud con datos codificados
-            response = requests.post(url, headers=import_headers, data=encoded_data, timeout=30)
+        # Only connection errors and 5xx are retried; a 4xx means the request itself is wrong
+        for attempt in range(1, IMPORT_ATTEMPTS + 1):
+            try:
+                # requests form-encodes the dict and sets the Content-Type
+                response = call(_betanin_cb, _session.post, TORRENTS_URL, data=data, timeout=30)
+            except requests.ConnectionError as e:
+                # Includes ConnectTimeout: the request never reached betanin, so it is safe to resend
+                logger.error(f"❌ Error in POST request (attempt {attempt}/{IMPORT_ATTEMPTS}): {e}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.error(traceback.format_exc())
+            except requests.RequestException as e:
+                # A read timeout may mean betanin already accepted the import, and the POST
+                # is not idempotent: sending it again could import the directory twice
+                logger.error(f"❌ Error in POST request, not retrying: {e}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.error(traceback.format_exc())
+                return False
+            else:
+                logger.info(f"📡 betanin response: Status {response.status_code}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("📝 Full response: %s", response.text[:500])
 
-            logger.info(f"📡 betanin response: Status {response.status_code}")
-            logger.debug(f"📝 Full response: {response.text[:500]}")
+                if response.status_code == 200:
+                    logger.info(f"✅ Import successful in betanin")
+                    return True
 
-            if response.status_code == 200:
-                logger.info(f"✅ Import successful in betanin")
-                return True
-            else:
-                logger.error(f"❌ Error in import. Code: {response.status_code}")
+                logger.error(f"❌ Error in import. Code: {response.status_code} (attempt {attempt}/{IMPORT_ATTEMPTS})")
                 try:
-                    logger.error(f"📝 JSON response: {json.dumps(response.json(), indent=2)}")
+                    logger.error(f"📝 JSON response: {dumps_pretty(loads(response.content))}")
                 except:
                     logger.error(f"📝 Text response: {response.text[:500]}")
 
-                # Sugerencias específicas según el código de error
-                if response.status_code == 400:
-                    logger.error("❌ Error 400: Incorrect request. Check data format.")
-                elif response.status_code == 404:
-                    logger.error("❌ Error 404: Route not found. Check API URL.")
-                elif response.status_code == 422:
-                    logger.error("❌ Error 422: Invalid data. Check directory path.")
-
-                return False
-        except Exception as e:
-            logger.error(f"❌ Error in POST request: {e}")
-            logger.error(traceback.format_exc())
-            return False
+                if response.status_code < 500:
+                    # Sugerencias específicas según el código de error
+                    if response.status_code == 400:
+                        logger.error("❌ Error 400: Incorrect request. Check data format.")
+                    elif response.status_code == 401:
+                        logger.error("🔐 Error 401: Incorrect API key or missing permissions.")
+                    elif response.status_code == 404:
+                        logger.error("❌ Error 404: Route not found. Check API URL.")
+                    elif response.status_code == 422:
+                        logger.error("❌ Error 422: Invalid data. Check directory path.")
+
+                    return False
+
+            if attempt < IMPORT_ATTEMPTS:
+                # The next attempt would be rejected right away, so don't wait for it.
+                # Returning False (instead of raising) lets the caller count the failure
+                # and rotate the directory, so one that always fails can't block the queue
+                if _betanin_cb.is_open():
+                    logger.error(f"⚡ {_betanin_cb.name} circuit opened, not retrying import")
+                    return False
+
+                # Exponential backoff with jitter so failed imports don't retry in lockstep
+                delay = min(2 ** (attempt - 1) + random.uniform(0, 0.5), IMPORT_MAX_DELAY)
+                logger.info(f"⏳ Retrying import in {delay:.1f} seconds...")
+                # Wait on the shutdown event so a SIGTERM doesn't sit out the backoff
+                if shutdown_event.wait(delay):
+                    logger.info("🛑 Shutdown requested, not retrying import")
+                    return False
+
+        logger.error(f"❌ Import failed after {IMPORT_ATTEMPTS} attempts")
+        return False
 
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logger.error(f"❌ Unexpected error communicating with betanin: {e}")
         logger.error(traceback.format_exc())
@@ -154,13 +200,12 @@ def get_download_outcome(download_id):
     """
     logger.info(f"🔍 Getting download outcome for ID {download_id}...")
 
-    url = f"{config.BETANIN_URL}/api/torrents/{download_id}/console/stdout"
-    headers = {"X-API-Key": config.BETANIN_API_KEY, "accept": "application/json"}
+    url = f"{TORRENTS_URL}{download_id}/console/stdout"
 
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        response = call(_betanin_cb, _session.get, url, timeout=10)
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
 
         logger.info(f"✅ Result obtained correctly")
 
@@ -168,6 +213,9 @@ def get_download_outcome(download_id):
             logger.info(f"📜 Output: {item.get('data', '')}")
 
         return data
+    except CircuitOpenError as e:
+        logger.warning(f"⚡ Cannot get download outcome: {e}")
+        return None
     except Exception as e:
         logger.error(f"❌ Error getting download outcome: {e}")
         logger.error(traceback.format_exc())
@@ -180,24 +228,15 @@ def check_manual_intervention_needed():
     """
     logger.info("🔍 Checking if manual intervention is needed...")
 
-    # Verificar si tenemos API key
-    if not config.BETANIN_API_KEY:
-        logger.error("❌ Cannot verify: BETANIN_API_KEY is not configured")
-        return False
-
-    url = f"{config.BETANIN_URL}/api/torrents/"
-    headers = {"X-API-Key": config.BETANIN_API_KEY, "accept": "application/json"}
-    params = {"page": 1, "per_page": 1}
-
     try:
-        logger.info(f"🔗 URL: {url}")
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        logger.debug("🔗 URL: %s", TORRENTS_URL)
+        response = call(_betanin_cb, _session.get, TORRENTS_URL, params=LATEST_TORRENT_PARAMS, timeout=10)
 
         if response.status_code != 200:
             logger.error(f"❌ Error checking status. Code: {response.status_code}")
             return False
 
-        data = response.json()
+        data = loads(response.content)
 
         if not data.get('torrents') or len(data['torrents']) == 0:
             logger.warning("⚠️ No torrents found in betanin")
@@ -211,12 +250,15 @@ def check_manual_intervention_needed():
 
         if download_status != "COMPLETED":
             logger.warning(f"⚠️ Manual intervention required in betanin. Status: {download_status}")
-            logger.warning(f"⚠️ Please check {config.BETANIN_URL}")
+            logger.warning(f"⚠️ Please check {CFG.BETANIN_URL}")
             get_download_outcome(download_id)
             return True
 
         logger.info("✅ No manual intervention required")
         return False
+    except CircuitOpenError as e:
+        logger.warning(f"⚡ Cannot check if manual intervention is needed: {e}")
+        return False
     except Exception as e:
         logger.error(f"❌ Error checking if manual intervention is needed: {e}")
         logger.error(traceback.format_exc())
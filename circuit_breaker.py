@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import logging
+import time
+from dataclasses import dataclass
+
+import requests
+
+logger = logging.getLogger("circuit_breaker")
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a call is short-circuited because the backend's circuit is open.
+    """
+
+
+@dataclass
+class CircuitBreaker:
+    """
+    Tracks consecutive failures against a backend and fails fast while it is down.
+
+    After failure_threshold consecutive failures the circuit opens and every
+    call is rejected until reset_timeout seconds have passed. The next call is
+    then let through (half open): a success closes the circuit again, a
+    failure reopens it.
+
+    Every failed call costs at most its own timeout, since the session does not
+    retry connect or read errors. The worst case to trip is therefore about
+    failure_threshold x timeout: ~50s for slskd (10s GETs, one per iteration)
+    and ~2.5 minutes for betanin (30s import POSTs, plus under 10s of retry
+    backoff). A refused connection fails immediately and trips much sooner.
+    """
+    name: str
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+    state: str = "closed"
+    consecutive_failures: int = 0
+    opened_at: float = 0.0
+
+    def is_open(self):
+        """
+        True while calls are being rejected; does not start a half-open trial.
+        """
+        return self.state == "open" and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def allow_request(self):
+        if self.state == "open":
+            if self.is_open():
+                return False
+            self.state = "half_open"
+            logger.info(f"🔌 {self.name} circuit half open, trying a request")
+        return True
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"✅ {self.name} circuit closed")
+        self.state = "closed"
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(
+                    f"⚡ {self.name} circuit open after {self.consecutive_failures} consecutive failures, "
+                    f"pausing requests for {self.reset_timeout:.0f} seconds")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+def call(breaker, fn, *args, **kwargs):
+    """
+    Performs an HTTP call through the given circuit breaker.
+
+    Network errors and 5xx responses count as failures; any other response
+    counts as a success.
+
+    Raises:
+        CircuitOpenError: If the circuit is open and the cooldown has not elapsed
+    """
+    if not breaker.allow_request():
+        raise CircuitOpenError(f"{breaker.name} circuit is open")
+
+    try:
+        response = fn(*args, **kwargs)
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
+
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+    return response
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def make_session(api_key, **headers):
+    """
+    Returns a requests.Session that reuses keep-alive connections to one backend.
+
+    The adapter only retries 502/503/504 responses to idempotent requests.
+    Connect and read errors are not retried here: each failed call reaches the
+    circuit breaker after a single timeout, and retrying imports is left to
+    betanin.import_downloads.
+
+    Args:
+        api_key: Value sent in the X-API-Key header on every request
+        headers: Extra headers sent on every request
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, connect=0, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"X-API-Key": api_key, **headers})
+    return session
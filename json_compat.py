@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+# orjson is optional: it decodes large slskd responses several times faster
+# than the standard library, which is used as a fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+
+def loads(content):
+    """
+    Parses a JSON document from bytes or str.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def dumps_pretty(obj):
+    """
+    Serializes obj as indented JSON, for debug output.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
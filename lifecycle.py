@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+import logging
+import signal
+import threading
+
+logger = logging.getLogger("lifecycle")
+
+# Se activa al recibir SIGTERM/SIGINT; cualquier espera larga debe usarlo para cortarse antes
+shutdown_event = threading.Event()
+# Despierta el bucle principal antes de tiempo (señales y eventos del sistema de ficheros)
+wake_event = threading.Event()
+
+
+def request_shutdown(signum, frame):
+    logger.info(f"🛑 Signal {signum} received, shutting down...")
+    shutdown_event.set()
+    wake_event.set()
+    # Un segundo Ctrl-C termina el proceso sin esperar
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+def install_signal_handlers():
+    """
+    Stops BeetSeeker cleanly on SIGTERM (docker stop) and SIGINT (Ctrl-C).
+    """
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
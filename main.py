@@ -1,25 +1,26 @@
 #!/usr/bin/env python3
 
+import os
 import time
 import logging
-import sys
 import json
 import traceback
 from collections import deque
-import config
+from concurrent.futures import ThreadPoolExecutor, wait
+from settings import CFG
+from lifecycle import install_signal_handlers, shutdown_event, wake_event
 import slskd
 import betanin
+from circuit_breaker import CircuitOpenError
 
+# watchdog es opcional: permite despertar el bucle en cuanto aparece un directorio nuevo
 try:
-    DEBUG = config.DEBUG
-except AttributeError:
-    DEBUG = False
-
-logging.basicConfig(
-    level=logging.DEBUG if DEBUG else logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
 logger = logging.getLogger("main")
 
 # Banner inicial para distinguir reinicios
@@ -28,44 +29,89 @@ logger.info("=" * 80)
 
 # Verificar configuración
 logger.info(f"📋 Configuration:")
-logger.info(f"- SLSKD_URL: {config.SLSKD_URL}")
-logger.info(f"- BETANIN_URL: {config.BETANIN_URL}")
-logger.info(f"- DOWNLOADS_DIRECTORY: {config.DOWNLOADS_DIRECTORY}")
-logger.info(f"- BETANIN_IMPORT_DIRECTORY: {config.BETANIN_IMPORT_DIRECTORY}")
-logger.info(f"- SLSKD API key configured: {'✅ Yes' if config.SLSKD_API_KEY else '❌ No'}")
-logger.info(f"- BETANIN API key configured: {'✅ Yes' if config.BETANIN_API_KEY else '❌ No'}")
-logger.info(f"- DEBUG mode: {'✅ Enabled' if DEBUG else '❌ Disabled'}")
-
-if not config.BETANIN_API_KEY:
-    logger.error(
-        "⚠️ BETANIN_API_KEY is not configured in config.py. You need to configure it to enable integration with betanin.")
-    logger.error("⚠️ Please access the betanin web interface, generate an API key and add it to config.py")
-
-# Processing queue
+logger.info(f"- SLSKD_URL: {CFG.SLSKD_URL}")
+logger.info(f"- BETANIN_URL: {CFG.BETANIN_URL}")
+logger.info(f"- DOWNLOADS_DIRECTORY: {CFG.DOWNLOADS_DIRECTORY}")
+logger.info(f"- BETANIN_IMPORT_DIRECTORY: {CFG.BETANIN_IMPORT_DIRECTORY}")
+logger.info(f"- DEBUG mode: {'✅ Enabled' if CFG.DEBUG else '❌ Disabled'}")
+
+# Intervalos de sondeo adaptativos (segundos)
+ACTIVE_POLL_INTERVAL = 2       # Descargas en curso: responder rápido
+POLL_INTERVAL = 5
+IDLE_POLL_INTERVAL = 30        # Sin descargas ni cola durante un rato
+IDLE_STREAK_THRESHOLD = 5
+
+# Processing queue, with a parallel set for O(1) membership checks
 subdirectory_queue = deque()
+queued_set = set()
 
 # Tracking sets
 previous_subdirectories = set()
 processed_directories = set()    
+skipped_directories = set()  # Directories given up on after too many failed imports
 processing_failures = {}  # Directory -> number of failed attempts
 
+
+# Parar limpiamente con SIGTERM/SIGINT
+install_signal_handlers()
+
+
+class DownloadsEventHandler(FileSystemEventHandler):
+    """
+    Wakes the main loop when files or directories appear in the downloads directory.
+    """
+
+    def on_created(self, event):
+        wake_event.set()
+
+    def on_moved(self, event):
+        wake_event.set()
+
+
+def start_downloads_observer():
+    """
+    Watches DOWNLOADS_DIRECTORY if watchdog is installed and the directory is reachable.
+    """
+    if Observer is None or not CFG.DOWNLOADS_DIRECTORY or not os.path.isdir(CFG.DOWNLOADS_DIRECTORY):
+        logger.debug("👀 Filesystem watcher disabled, relying on polling only")
+        return None
+
+    observer = Observer()
+    observer.schedule(DownloadsEventHandler(), CFG.DOWNLOADS_DIRECTORY, recursive=True)
+    observer.daemon = True
+    observer.start()
+    logger.info(f"👀 Watching {CFG.DOWNLOADS_DIRECTORY} for new downloads")
+    return observer
+
+
+def enqueue(directory):
+    if directory not in queued_set:
+        subdirectory_queue.append(directory)
+        queued_set.add(directory)
+
+
+def dequeue():
+    directory = subdirectory_queue.popleft()
+    queued_set.discard(directory)
+    return directory
+
+
 # Check initial download status
 logger.info("🔍 Checking initial download status...")
 download_data = slskd.get_download_status()
 
 # Get directories and check which are completed
 logger.info("🔍 Getting initial directories...")
-all_subdirectories = slskd.get_subdirectories(config.DOWNLOADS_DIRECTORY)
-completed_directories = slskd.get_completed_directories(download_data)
+idx = slskd._index_downloads(download_data)
+completed_directories = slskd.get_completed_directories(download_data, _index=idx)
 
-# Update previous directories set
-previous_subdirectories = all_subdirectories
+# Update previous directories set, derived from the index exactly as in the main loop
+previous_subdirectories = {dir_name for dir_name, _, _, _ in idx.values()}
 
 # Encolar directorios completos iniciales
-for directory in completed_directories:
-    if directory not in processed_directories:
-        logger.info(f"📥 Enqueueing complete directory: {directory}")
-        subdirectory_queue.append(directory)
+for directory in sorted(completed_directories - processed_directories):
+    logger.info(f"📥 Enqueueing complete directory: {directory}")
+    enqueue(directory)
 
 if subdirectory_queue:
     logger.info(f"📋 Initial queue: {len(subdirectory_queue)} complete directories ready to process")
@@ -76,116 +122,154 @@ else:
 # Function to show queue status
 def log_queue_status():
     if subdirectory_queue:
-        logger.info(f"📋 Current queue: {len(subdirectory_queue)} directories")
-        if DEBUG and len(subdirectory_queue) > 0:
+        logger.debug("📋 Current queue: %d directories", len(subdirectory_queue))
+        if logger.isEnabledFor(logging.DEBUG):
             preview = list(subdirectory_queue)[:3]
-            logger.debug(f"First in queue: {preview}{'...' if len(subdirectory_queue) > 3 else ''}")
+            logger.debug("First in queue: %s%s", preview, '...' if len(subdirectory_queue) > 3 else '')
+    else:
+        logger.debug("📋 Queue is empty, no directories to process")
+
+
+# Function to import the directory at the head of the queue
+def process_queue_head(download_data, index):
+    """
+    Imports the first directory in the queue if it is still complete in download_data.
+    """
+    if subdirectory_queue:
+        # Get next directory without removing it from the queue yet
+        subdirectory = subdirectory_queue[0]
+
+        # Verificar nuevamente que el directorio está completo (por si cambió mientras estaba en cola)
+        is_completed = slskd.is_directory_completed(download_data, subdirectory, _index=index)
+
+        if is_completed:
+            logger.info(f"🔄 PROCESSING complete directory: {subdirectory}")
+
+            # Intentar importar
+            success = betanin.import_downloads(subdirectory, download_data, _index=index)
+
+            if success:
+                logger.info(f"✅ Directory sent to betanin: {subdirectory}")
+
+                logger.info("🔍 Checking if manual intervention is needed...")
+                if betanin.check_manual_intervention_needed():
+                    logger.warning(f"⚠️ Manual intervention required for {subdirectory}")
+                else:
+                    logger.info(f"✅ Successful processing of {subdirectory}")
+
+                # Marcar como procesado y quitar de la cola
+                processed_directories.add(subdirectory)
+                dequeue()
+            else:
+                # Registrar el fallo (los errores transitorios ya se reintentaron en import_downloads)
+                if subdirectory in processing_failures:
+                    processing_failures[subdirectory] += 1
+                else:
+                    processing_failures[subdirectory] = 1
+
+                # Si ha fallado demasiadas veces, quitarlo de la cola
+                if processing_failures[subdirectory] >= 3:
+                    logger.error(f"❌ Too many failed attempts for {subdirectory}, skipping")
+                    skipped_directories.add(subdirectory)
+                    dequeue()
+                else:
+                    logger.error(
+                        f"❌ Import failed for {subdirectory} (attempt {processing_failures[subdirectory]}/3)")
+                    # Move to end of queue to try later
+                    subdirectory_queue.rotate(-1)
+        else:
+            logger.debug("⏸️ The directory %s is not complete, moving to end of queue", subdirectory)
+            # Move to end of queue to check later
+            subdirectory_queue.rotate(-1)
     else:
-        logger.info("📋 Queue is empty, no directories to process")
+        logger.debug("⏸️ No complete directories to process")
 
 
 # Bucle principal
+observer = start_downloads_observer()
+# Un solo hilo: la consulta a slskd de cada iteración se solapa con el trabajo de betanin
+poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slskd-poll")
 iteration = 0
-while True:
+idle_streak = 0
+while not shutdown_event.is_set():
+    iteration_start = time.monotonic()
+    active_downloads = False
     try:
         iteration += 1
-        logger.info(f"\n--- ITERATION {iteration} ---")
-
-        # Obtener directorios actuales y estado de descargas
-        logger.info("🔍 Checking directories and download status...")
-        download_data = slskd.get_download_status()
-        current_subdirectories = slskd.get_subdirectories(config.DOWNLOADS_DIRECTORY)
-        completed_directories = slskd.get_completed_directories(download_data)
+        logger.debug("\n--- ITERATION %d ---", iteration)
+
+        # Consultar slskd en segundo plano mientras betanin importa la cabeza de la cola,
+        # que ya se comprobó completa con la consulta anterior
+        logger.debug("🔍 Checking directories and download status...")
+        previous_download_data = download_data
+        poll = poll_executor.submit(slskd.get_download_status)
+        try:
+            process_queue_head(previous_download_data, idx)
+        finally:
+            # No dejar la consulta corriendo hacia la siguiente iteración
+            wait([poll])
+        download_data = poll.result()
+
+        # slskd returns the same object when nothing changed, so the index can be reused
+        if download_data is not previous_download_data:
+            idx = slskd._index_downloads(download_data)
+        # Solo cuentan como activas las transferencias en curso, no los estados finales fallidos
+        active_downloads = any(in_flight for _, _, _, in_flight in idx.values())
+        # Directorios actuales derivados del índice, sin otra consulta a slskd
+        current_subdirectories = {dir_name for dir_name, _, _, _ in idx.values()}
+        completed_directories = slskd.get_completed_directories(download_data, _index=idx)
 
         # Encontrar nuevos directorios
         new_subdirectories = current_subdirectories - previous_subdirectories
 
-        # Actualizar la cola con nuevos directorios completos
         if new_subdirectories:
             logger.info(f"✨ {len(new_subdirectories)} new directories detected")
 
-            for directory in new_subdirectories:
-                if directory in completed_directories and directory not in processed_directories:
-                    logger.info(f"📥 Enqueueing new complete directory: {directory}")
-                    subdirectory_queue.append(directory)
-
-        # También verificar directorios existentes que se han completado recientemente
-        for directory in current_subdirectories:
-            if (directory in completed_directories and
-                    directory not in processed_directories and
-                    directory not in subdirectory_queue):
-                logger.info(f"📥 Enqueueing recently completed directory: {directory}")
-                subdirectory_queue.append(directory)
+        # Encolar los directorios completos (nuevos o completados recientemente) en un solo paso
+        to_enqueue = completed_directories - processed_directories - skipped_directories - queued_set
+        for directory in sorted(to_enqueue):
+            logger.info(f"📥 Enqueueing complete directory: {directory}")
+            enqueue(directory)
 
         # Check queue status
         log_queue_status()
 
-        # Process directories in queue
-        if subdirectory_queue:
-            # Get next directory without removing it from the queue yet
-            subdirectory = subdirectory_queue[0]
-
-            # Verificar nuevamente que el directorio está completo (por si cambió mientras estaba en cola)
-            is_completed = slskd.is_directory_completed(download_data, subdirectory)
-
-            if is_completed:
-                logger.info(f"🔄 PROCESSING complete directory: {subdirectory}")
+        # Update previous directories
+        previous_subdirectories = current_subdirectories
 
-                # Verificar configuración de betanin antes de intentar importar
-                if not config.BETANIN_API_KEY:
-                    logger.error("❌ Cannot import to betanin: BETANIN_API_KEY is not configured")
-                    logger.error("❌ Configure it in config.py and restart BeetSeeker")
-                    # Remove directory from queue to avoid blocking
-                    subdirectory_queue.popleft()
-                    continue
+        logger.info("iter=%d queue=%d new=%d completed=%d",
+                    iteration, len(subdirectory_queue), len(new_subdirectories), len(completed_directories))
 
-                # Intentar importar
-                success = betanin.import_downloads(subdirectory)
+    except CircuitOpenError as e:
+        logger.warning(f"⚡ {e}, skipping iteration")
+    except Exception as e:
+        logger.error(f"❌ Error in main loop: {e}")
+        logger.error(traceback.format_exc())
 
-                if success:
-                    logger.info(f"✅ Directory sent to betanin: {subdirectory}")
+    # Elegir el intervalo según la actividad de slskd
+    if active_downloads or subdirectory_queue:
+        idle_streak = 0
+    else:
+        idle_streak += 1
 
-                    logger.info("🔍 Checking if manual intervention is needed...")
-                    if betanin.check_manual_intervention_needed():
-                        logger.warning(f"⚠️ Manual intervention required for {subdirectory}")
-                    else:
-                        logger.info(f"✅ Successful processing of {subdirectory}")
+    if active_downloads:
+        sleep_s = ACTIVE_POLL_INTERVAL
+    elif idle_streak > IDLE_STREAK_THRESHOLD:
+        sleep_s = IDLE_POLL_INTERVAL
+    else:
+        sleep_s = POLL_INTERVAL
 
-                    # Marcar como procesado y quitar de la cola
-                    processed_directories.add(subdirectory)
-                    subdirectory_queue.popleft()
-                else:
-                    # Registrar el fallo
-                    if subdirectory in processing_failures:
-                        processing_failures[subdirectory] += 1
-                    else:
-                        processing_failures[subdirectory] = 1
-
-                    # Si ha fallado demasiadas veces, quitarlo de la cola
-                    if processing_failures[subdirectory] >= 3:
-                        logger.error(f"❌ Too many failed attempts for {subdirectory}, skipping")
-                        subdirectory_queue.popleft()
-                    else:
-                        logger.error(
-                            f"❌ Import failed for {subdirectory} (attempt {processing_failures[subdirectory]}/3)")
-                        # Move to end of queue to try later
-                        subdirectory_queue.popleft()
-                        subdirectory_queue.append(subdirectory)
-            else:
-                logger.info(f"⏸️ The directory {subdirectory} is not complete, moving to end of queue")
-                # Move to end of queue to check later
-                subdirectory_queue.popleft()
-                subdirectory_queue.append(subdirectory)
-        else:
-            logger.info("⏸️ No complete directories to process")
+    # Esperar antes de la próxima verificación, descontando el tiempo de trabajo
+    remaining = max(0.0, sleep_s - (time.monotonic() - iteration_start))
+    logger.debug("💤 Waiting %.1f seconds before next check...\n", remaining)
+    if wake_event.wait(timeout=remaining) and not shutdown_event.is_set():
+        logger.debug("🔔 Woken up early by a filesystem event")
+    wake_event.clear()
 
-        # Update previous directories
-        previous_subdirectories = current_subdirectories
+poll_executor.shutdown()
 
-    except Exception as e:
-        logger.error(f"❌ Error in main loop: {e}")
-        logger.error(traceback.format_exc())
+if observer is not None:
+    observer.stop()
+    observer.join()
 
-    # Esperar antes de la próxima verificación
-    logger.info(f"💤 Waiting 5 seconds before next check...\n")
-    time.sleep(5)
\ No newline at end of file
+logger.info("👋 BeetSeeker stopped")
\ No newline at end of file
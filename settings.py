@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import atexit
+import logging
+import os
+import queue
+import sys
+from dataclasses import dataclass, fields
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import config
+except ImportError:
+    # Sin config.py: toda la configuración viene de variables de entorno
+    config = None
+
+REQUIRED = ("SLSKD_URL", "SLSKD_API_KEY", "BETANIN_URL", "BETANIN_API_KEY", "BETANIN_IMPORT_DIRECTORY")
+
+
+@dataclass(frozen=True)
+class Config:
+    """
+    BeetSeeker configuration, validated once at startup.
+    """
+    SLSKD_URL: str = ""
+    SLSKD_API_KEY: str = ""
+    BETANIN_URL: str = ""
+    BETANIN_API_KEY: str = ""
+    DOWNLOADS_DIRECTORY: str = ""
+    BETANIN_IMPORT_DIRECTORY: str = ""
+    DEBUG: bool = False
+
+    def __post_init__(self):
+        missing = [name for name in REQUIRED if not getattr(self, name)]
+        if missing:
+            raise ValueError(f"Missing required configuration: {', '.join(missing)}. "
+                             f"Set them in config.py or as environment variables.")
+
+    @classmethod
+    def load(cls):
+        """
+        Builds the configuration from config.py, overridden by environment variables.
+        """
+        values = {}
+        for field in fields(cls):
+            value = os.environ.get(field.name)
+            if value is None:
+                value = getattr(config, field.name, field.default)
+            elif field.type is bool:
+                value = value.strip().lower() in ("1", "true", "yes", "on")
+            values[field.name] = value
+
+        for name in ("SLSKD_URL", "BETANIN_URL"):
+            values[name] = values[name].rstrip("/")
+
+        return cls(**values)
+
+
+def _setup_logging(debug):
+    """
+    Routes all log records through a queue so that the final formatting
+    (timestamp, logger name, level) and the stdout writes happen on a
+    background thread instead of in the polling loop. Message interpolation
+    still runs on the calling thread, when QueueHandler prepares the record.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+
+    # Se añade directamente al root logger: basicConfig le pondría su propio formato al QueueHandler
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG if debug else logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    listener.start()
+    # Vaciar la cola antes de salir
+    atexit.register(listener.stop)
+
+
+try:
+    CFG = Config.load()
+except ValueError as e:
+    sys.exit(f"❌ {e}")
+
+_setup_logging(CFG.DEBUG)
@@ -1,63 +1,84 @@
 #!/usr/bin/env python3
 
-import requests
 import logging
-import sys
-import json
+import hashlib
 import traceback
-import config
-
-# Configurar logging con nivel basado en config.DEBUG
-try:
-    DEBUG = config.DEBUG
-except AttributeError:
-    # Si no está definido en config, default a False
-    DEBUG = False
-
-logging.basicConfig(
-    level=logging.DEBUG if DEBUG else logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+from functools import lru_cache
+from settings import CFG
+from json_compat import dumps_pretty, loads
+from circuit_breaker import CircuitBreaker, CircuitOpenError, call
+from http_session import make_session
+
 logger = logging.getLogger("slskd")
 
+_session = make_session(CFG.SLSKD_API_KEY)
+
+# Corta las consultas durante una caída de slskd en vez de esperar cada timeout
+_slskd_cb = CircuitBreaker("slskd")
+
+DOWNLOADS_URL = f"{CFG.SLSKD_URL}/api/v0/transfers/downloads"
+DOWNLOADS_PARAMS = {'includeRemoved': 'false'}
+
+# Última respuesta de descargas: si no ha cambiado se reutiliza sin volver a parsear
+_last_hash = None
+_last_parsed = None
+_last_etag = None
+_last_modified = None
+
+
+@lru_cache(maxsize=1024)
+def _normalize(dir_path):
+    """
+    Returns the directory name (last path component) of a slskd directory path.
+
+    slskd sends Windows or POSIX style paths; the same paths repeat on every
+    poll, so the result is cached.
+    """
+    # Normalizar la ruta (convertir barras invertidas a barras normales)
+    # y obtener el último componente como nombre del directorio
+    return dir_path.replace('\\', '/').rstrip('/').split('/')[-1]
+
 
-def get_subdirectories(directory):
+def get_subdirectories(directory, download_data=None):
     """
     Returns a set of subdirectories obtained from the download status API.
     Uses the API instead of direct filesystem access.
+
+    Args:
+        directory: The slskd downloads directory (unused, kept for compatibility)
+        download_data: Download status data already fetched; if None, it is fetched
     """
-    logger.info(f"🔍 Getting directories from slskd API...")
+    if download_data is None:
+        logger.debug("🔍 Getting directories from slskd API...")
+        download_data = get_download_status()
 
-    download_data = get_download_status()
     directories = set()
 
     if not download_data:
         logger.warning("⚠️ Could not get data from slskd API")
         return directories
 
-    logger.debug(f"📊 Download data received: {len(download_data)} users")
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("📊 Download data received: %d users", len(download_data))
 
     for user in download_data:
         for directory_info in user.get('directories', []):
             # Extraer el nombre del directorio de la ruta completa
             dir_path = directory_info.get('directory', '')
             if dir_path:
-                # Normalizar la ruta (convertir barras invertidas a barras normales)
-                dir_path = dir_path.replace('\\', '/')
-                # Obtener el último componente de la ruta como nombre del directorio
-                dir_name = dir_path.rstrip('/').split('/')[-1]
+                dir_name = _normalize(dir_path)
                 directories.add(dir_name)
-                if DEBUG:
-                    logger.debug(f"📁 Directory found: {dir_name} (full path: {dir_path})")
+                if debug:
+                    logger.debug("📁 Directory found: %s (full path: %s)", dir_name, dir_path)
 
     if directories:
-        logger.info(f"✅ {len(directories)} directories found")
-        if DEBUG:
-            logger.debug(
-                f"📂 List of directories: {', '.join(list(directories)[:5])}{'...' if len(directories) > 5 else ''}")
+        logger.debug("✅ %d directories found", len(directories))
+        if debug:
+            logger.debug("📂 List of directories: %s%s",
+                         ', '.join(list(directories)[:5]), '...' if len(directories) > 5 else '')
     else:
-        logger.info("📭 No directories found")
+        logger.debug("📭 No directories found")
 
     return directories
 
@@ -65,187 +86,207 @@ def get_subdirectories(directory):
 def get_download_status():
     """
     Returns the download status from the slskd API.
+
+    If the response is unchanged since the previous call (304, or an identical
+    body), the previously parsed data is returned as-is.
+
+    Raises:
+        CircuitOpenError: If slskd has failed repeatedly and is being skipped
     """
-    url = f"{config.SLSKD_URL}/api/v0/transfers/downloads"
-    params = {'includeRemoved': 'false'}
-    headers = {'X-API-Key': config.SLSKD_API_KEY}
+    global _last_hash, _last_parsed, _last_etag, _last_modified
+
+    # Conditional request headers, if slskd sent validators last time
+    headers = {}
+    if _last_parsed is not None:
+        if _last_etag:
+            headers['If-None-Match'] = _last_etag
+        if _last_modified:
+            headers['If-Modified-Since'] = _last_modified
 
     try:
-        logger.info(f"🔄 Consulting slskd API: {url}")
-        if DEBUG:
-            logger.debug(f"🔑 Headers: {headers}")
-            logger.debug(f"🔍 Parameters: {params}")
+        logger.debug("🔄 Consulting slskd API: %s", DOWNLOADS_URL)
+        logger.debug("🔍 Parameters: %s", DOWNLOADS_PARAMS)
 
-        response = requests.get(url, params=params, headers=headers, timeout=10)
+        response = call(_slskd_cb, _session.get, DOWNLOADS_URL, params=DOWNLOADS_PARAMS, headers=headers, timeout=10)
 
-        logger.info(f"📡 slskd response: Status {response.status_code}")
+        logger.debug("📡 slskd response: Status %d", response.status_code)
+
+        if response.status_code == 304 and _last_parsed is not None:
+            logger.debug("✅ Download data not modified, reusing previous data")
+            return _last_parsed
 
         if response.status_code == 200:
-            data = response.json()
-            logger.info(f"✅ Download data received correctly")
-            if DEBUG:
+            _last_etag = response.headers.get('ETag')
+            _last_modified = response.headers.get('Last-Modified')
+
+            content_hash = hashlib.blake2b(response.content, digest_size=16).digest()
+            if content_hash == _last_hash:
+                logger.debug("✅ Download data unchanged, reusing previous data")
+                return _last_parsed
+
+            data = loads(response.content)
+            _last_hash = content_hash
+            _last_parsed = data
+            logger.debug("✅ Download data received correctly")
+            if logger.isEnabledFor(logging.DEBUG):
                 sample_data = data[:1] if data else []
-                logger.debug(f"📊 Sample data: {json.dumps(sample_data, indent=2)}")
+                logger.debug("📊 Sample data: %s", dumps_pretty(sample_data))
             return data
         else:
             logger.error(f"❌ Error getting data. Code: {response.status_code}")
             logger.error(f"📝 Response: {response.text[:500]}")
             return []
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logger.error(f"❌ Error getting download status: {e}")
-        if DEBUG:
+        if logger.isEnabledFor(logging.DEBUG):
             logger.error(traceback.format_exc())
         return []
 
 
-def all_downloads_completed(data):
-    """
-    Checks if all downloads are completed.
+def _index_downloads(data):
     """
-    if not data:
-        logger.warning("⚠️ No download data to check")
-        return False, 0, 0
+    Builds a per-directory summary of the download data in a single pass.
 
-    total_files = 0
-    completed_files = 0
+    Args:
+        data: Download status data from the API
 
-    logger.info("🔍 Checking download status...")
+    Returns:
+        Dictionary {dir_name_casefold: [dir_name, total_files, completed_files, in_flight_files]}.
+        in_flight_files counts files still transferring: final states such as
+        'Completed, Errored' or 'Completed, Cancelled' are neither completed nor in flight.
+    """
+    index = {}
 
-    for user in data:
-        username = user.get('username', 'Unknown')
+    for user in data or []:
         for directory in user.get('directories', []):
-            dir_name = directory.get('directory', '').replace('\\', '/').split('/')[-1]
+            dir_path = directory.get('directory', '')
+            if not dir_path:
+                continue
 
-            for file in directory.get('files', []):
-                filename = file.get('filename', 'Unknown')
-                state = file.get('state', 'Unknown')
+            # Normalize and extract directory name, once per directory
+            dir_name = _normalize(dir_path)
+            key = dir_name.casefold()
 
-                total_files += 1
+            # Initialize counters if it's the first time we see this directory
+            entry = index.get(key)
+            if entry is None:
+                entry = index[key] = [dir_name, 0, 0, 0]
 
+            # Count files in this directory
+            for file in directory.get('files', []):
+                entry[1] += 1  # Increment total_files
+                state = file.get('state', '')
                 if state == 'Completed, Succeeded':
-                    completed_files += 1
-                    if DEBUG:
-                        logger.debug(f"✅ File completed: {filename} in {dir_name} of {username}")
-                else:
-                    if DEBUG:
-                        logger.debug(f"⏳ File in progress: {filename} in {dir_name} of {username}, state: {state}")
+                    entry[2] += 1  # Increment completed_files
+                elif not state.startswith('Completed'):
+                    entry[3] += 1  # Increment in_flight_files
+
+    return index
+
+
+def all_downloads_completed(data, _index=None):
+    """
+    Checks if all downloads are completed.
+
+    Args:
+        data: Download status data from the API
+        _index: Prebuilt index from _index_downloads; if given, data is not scanned
+    """
+    index = _index if _index is not None else _index_downloads(data)
+
+    if not index:
+        logger.warning("⚠️ No download data to check")
+        return False, 0, 0
+
+    logger.debug("🔍 Checking download status...")
+
+    total_files = 0
+    completed_files = 0
+    debug = logger.isEnabledFor(logging.DEBUG)
+
+    for dir_name, dir_total, dir_completed, _ in index.values():
+        total_files += dir_total
+        completed_files += dir_completed
+        if debug:
+            logger.debug("📁 %s: %d/%d files completed", dir_name, dir_completed, dir_total)
 
     all_completed = (completed_files == total_files and total_files > 0)
 
     if all_completed:
-        logger.info(f"✅ All downloads completed: {completed_files}/{total_files} files")
+        logger.debug("✅ All downloads completed: %d/%d files", completed_files, total_files)
     else:
-        logger.info(f"⏳ Downloads in progress: {completed_files}/{total_files} files completed")
+        logger.debug("⏳ Downloads in progress: %d/%d files completed", completed_files, total_files)
 
     return all_completed, completed_files, total_files
 
 
-def get_completed_directories(data):
+def get_completed_directories(data, _index=None):
     """
-    Returns a list of directories that have all their downloads completed.
+    Returns the set of directories that have all their downloads completed.
 
     Args:
         data: Download status data from the API
+        _index: Prebuilt index from _index_downloads; if given, data is not scanned
 
     Returns:
-        List of directories with all downloads completed
+        Set of directories with all downloads completed
     """
-    if not data:
-        logger.warning("⚠️ No download data to check complete directories")
-        return []
-
-    logger.info("🔍 Analyzing directories with completed downloads...")
-
-    # Dictionary to store directory information: {dir_name: [total_files, completed_files]}
-    directories_status = {}
-
-    # Process data to calculate total and completed files per directory
-    for user in data:
-        for directory in user.get('directories', []):
-            # Get normalized directory name
-            dir_path = directory.get('directory', '')
-            if not dir_path:
-                continue
-
-            # Normalize directory name
-            dir_path = dir_path.replace('\\', '/')
-            dir_name = dir_path.rstrip('/').split('/')[-1]
+    index = _index if _index is not None else _index_downloads(data)
 
-            # Initialize counters if it's the first time we see this directory
-            if dir_name not in directories_status:
-                directories_status[dir_name] = [0, 0]  # [total_files, completed_files]
-
-            # Count files in this directory
-            for file in directory.get('files', []):
-                directories_status[dir_name][0] += 1  # Increment total_files
+    if not index:
+        logger.warning("⚠️ No download data to check complete directories")
+        return set()
 
-                if file.get('state') == 'Completed, Succeeded':
-                    directories_status[dir_name][1] += 1  # Increment completed_files
+    logger.debug("🔍 Analyzing directories with completed downloads...")
 
     # Determine which directories are complete
-    completed_directories = []
+    completed_directories = set()
     in_progress_directories = []
+    debug = logger.isEnabledFor(logging.DEBUG)
 
-    for dir_name, counts in directories_status.items():
-        total_files, completed_files = counts
-
+    for dir_name, total_files, completed_files, _ in index.values():
         if total_files > 0 and completed_files == total_files:
-            completed_directories.append(dir_name)
-            if DEBUG:
-                logger.debug(f"✅ Directory complete: {dir_name} ({completed_files}/{total_files} files)")
+            completed_directories.add(dir_name)
+            if debug:
+                logger.debug("✅ Directory complete: %s (%d/%d files)", dir_name, completed_files, total_files)
         else:
             in_progress_directories.append(dir_name)
-            if DEBUG:
-                logger.debug(f"⏳ Directory in progress: {dir_name} ({completed_files}/{total_files} files)")
+            if debug:
+                logger.debug("⏳ Directory in progress: %s (%d/%d files)", dir_name, completed_files, total_files)
 
-    logger.info(f"✅ {len(completed_directories)} directories with completed downloads")
-    logger.info(f"⏳ {len(in_progress_directories)} directories with downloads in progress")
+    logger.debug("✅ %d directories with completed downloads", len(completed_directories))
+    logger.debug("⏳ %d directories with downloads in progress", len(in_progress_directories))
 
-    if DEBUG and completed_directories:
-        preview = completed_directories[:5]
-        logger.debug(f"📂 Sample of complete directories: {preview}{'...' if len(completed_directories) > 5 else ''}")
+    if debug and completed_directories:
+        preview = list(completed_directories)[:5]
+        logger.debug("📂 Sample of complete directories: %s%s",
+                     preview, '...' if len(completed_directories) > 5 else '')
 
     return completed_directories
 
 
-def is_directory_completed(data, directory_name):
+def is_directory_completed(data, directory_name, _index=None):
     """
     Checks if a specific directory has all its downloads completed.
 
     Args:
         data: Download status data from the API
         directory_name: Name of the directory to check
+        _index: Prebuilt index from _index_downloads; if given, data is not scanned
 
     Returns:
         bool: True if all downloads for this directory are completed, False otherwise
     """
-    if not data:
+    index = _index if _index is not None else _index_downloads(data)
+
+    if not index:
         logger.warning(f"⚠️ No data to check status of {directory_name}")
         return False
 
-    total_files = 0
-    completed_files = 0
-
-    # Normalize directory name for comparisons
-    directory_name_lower = directory_name.lower()
-
-    for user in data:
-        for directory in user.get('directories', []):
-            dir_path = directory.get('directory', '')
-            if not dir_path:
-                continue
-
-            # Normalize and extract directory name
-            dir_path = dir_path.replace('\\', '/')
-            dir_name = dir_path.rstrip('/').split('/')[-1]
-
-            # Check if this is the directory we are looking for (case insensitive comparison)
-            if dir_name.lower() == directory_name_lower:
-                # Count files and their state
-                for file in directory.get('files', []):
-                    total_files += 1
-                    if file.get('state') == 'Completed, Succeeded':
-                        completed_files += 1
+    # Case insensitive lookup
+    _, total_files, completed_files, _ = index.get(directory_name.casefold(), (directory_name, 0, 0, 0))
 
     # If we don't find any files, we can't determine the status
     if total_files == 0:
@@ -256,8 +297,8 @@ def is_directory_completed(data, directory_name):
     is_completed = (completed_files == total_files)
 
     if is_completed:
-        logger.info(f"✅ Directory {directory_name} complete: {completed_files}/{total_files} files")
+        logger.debug("✅ Directory %s complete: %d/%d files", directory_name, completed_files, total_files)
     else:
-        logger.info(f"⏳ Directory {directory_name} in progress: {completed_files}/{total_files} files")
+        logger.debug("⏳ Directory %s in progress: %d/%d files", directory_name, completed_files, total_files)
 
-    return is_completed
\ No newline at end of file
+    return is_completed